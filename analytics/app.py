@@ -1,15 +1,20 @@
 import os
+import atexit
+import functools
+import queue
+import re
 import sqlite3
 import hashlib
-import hmac
 import ipaddress
-from datetime import datetime, timezone
+import threading
+import time
+from collections import Counter
 from urllib.parse import urlparse
 
-from flask import Flask, request, abort, Response, g, render_template_string, jsonify
+from flask import Flask, request, abort, Response, jsonify
+from werkzeug.datastructures import Headers
 
-import geoip2.database
-import geoip2.errors
+import maxminddb
 
 # -----------------------------------------------------------------------------
 # Config
@@ -17,15 +22,52 @@ import geoip2.errors
 DB_PATH = os.environ.get("ANALYTICS_DB", "analytics.sqlite3")
 DASH_TOKEN = os.environ.get("ANALYTICS_DASH_TOKEN", "changeme")
 IP_SALT = os.environ.get("ANALYTICS_IP_SALT", "please-change-me-and-keep-secret")
+IP_SALT_BYTES = IP_SALT.encode("utf-8")
+# BLAKE2b keys are capped at 64 bytes; longer salts are hashed down instead of cut off
+IP_HASH_KEY = IP_SALT_BYTES if len(IP_SALT_BYTES) <= 64 else hashlib.blake2b(IP_SALT_BYTES).digest()
+# Keyed hasher with the key block already absorbed; anonymize_ip copies it per call
+IP_HASHER = hashlib.blake2b(key=IP_HASH_KEY, digest_size=8)
 RETENTION_DAYS = int(os.environ.get("ANALYTICS_RETENTION_DAYS", "180"))
+# How often (seconds) the background retention DELETEs run
+RETENTION_INTERVAL = int(os.environ.get("ANALYTICS_RETENTION_INTERVAL", "3600"))
+# How often (seconds) the background thread checkpoints the WAL into the DB file
+CHECKPOINT_INTERVAL = int(os.environ.get("ANALYTICS_CHECKPOINT_INTERVAL", "30"))
+# Whether this process runs retention and WAL checkpoints. Exactly one process
+# per DB file should: on by default for a single `flask run`, off in the Docker
+# image, where docker-compose enables it only for the ingest sidecar.
+RUN_MAINTENANCE = os.environ.get("ANALYTICS_MAINTENANCE", "1") == "1"
+
+# Background writer: ingest routes only enqueue rows, one thread commits them
+# in batches of up to WRITE_BATCH_ROWS, at most WRITE_FLUSH_INTERVAL seconds late.
+WRITE_QUEUE_SIZE = int(os.environ.get("ANALYTICS_WRITE_QUEUE_SIZE", "10000"))
+WRITE_BATCH_ROWS = int(os.environ.get("ANALYTICS_WRITE_BATCH_ROWS", "500"))
+WRITE_FLUSH_INTERVAL = int(os.environ.get("ANALYTICS_WRITE_FLUSH_MS", "100")) / 1000
 GEOIP_DB_PATH = os.environ.get("GEOIP_DB_PATH", "/geoip/GeoLite2-Country.mmdb")
+# How often (seconds) to look for the GeoIP DB again while it is missing
+GEOIP_RETRY_INTERVAL = 60
+
+# Applied to every SQLite connection right after connect.
+# WAL lets /stats readers run alongside writers, synchronous=NORMAL drops the
+# fsync on every commit (WAL is still fsynced on checkpoint).
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA busy_timeout=3000;
+"""
+# How long (ms) init_db waits for another process's schema migration
+INIT_BUSY_TIMEOUT_MS = 600000
 
 # CORS allowlist (for cross-origin usage if you still call analytics.xmb.li from another domain)
 CORS_ALLOW_ORIGINS = os.environ.get(
     "CORS_ALLOW_ORIGINS",
     "https://mbh.photos"
 ).split(",")
-CORS_ALLOW_ORIGINS = [o.strip() for o in CORS_ALLOW_ORIGINS if o.strip()]
+CORS_ALLOW_ORIGINS = frozenset(o.strip() for o in CORS_ALLOW_ORIGINS if o.strip())
+# Endpoints never fetched cross-origin by script (the pixel is a plain <img>)
+NO_CORS_ENDPOINTS = frozenset({"pixel", "healthz", "stats"})
 
 # 1x1 transparent gif bytes (tracking pixel)
 PIXEL_BYTES = (
@@ -42,74 +84,87 @@ PIXEL_BYTES = (
     b"\x3b"
 )
 
+# Pixel response headers, built once instead of per hit
+PIXEL_HEADERS = Headers([
+    ("Content-Type", "image/gif"),
+    ("Content-Length", str(len(PIXEL_BYTES))),
+    ("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0"),
+    ("Pragma", "no-cache"),
+    ("Expires", "0"),
+])
+
 app = Flask(__name__)
 
 geoip_reader = None
+geoip_next_check = 0.0
 def get_geoip_reader():
-    global geoip_reader
-    if geoip_reader is None:
+    """
+    Open the MaxMind DB once per process, memory-mapped through the C
+    extension when it is available. While the DB is missing or unreadable,
+    look again at most every GEOIP_RETRY_INTERVAL seconds.
+    """
+    global geoip_reader, geoip_next_check
+    if geoip_reader is None and time.monotonic() >= geoip_next_check:
+        geoip_next_check = time.monotonic() + GEOIP_RETRY_INTERVAL
         if os.path.exists(GEOIP_DB_PATH):
-            geoip_reader = geoip2.database.Reader(GEOIP_DB_PATH)
-        else:
-            geoip_reader = None
+            try:
+                try:
+                    geoip_reader = maxminddb.open_database(GEOIP_DB_PATH, mode=maxminddb.MODE_MMAP_EXT)
+                except (ImportError, ValueError):
+                    # maxminddb built without the libmaxminddb extension
+                    geoip_reader = maxminddb.open_database(GEOIP_DB_PATH, mode=maxminddb.MODE_MMAP)
+            except (OSError, ValueError, maxminddb.InvalidDatabaseError):
+                app.logger.exception("could not open GeoIP DB %s", GEOIP_DB_PATH)
     return geoip_reader
 
 
 # -----------------------------------------------------------------------------
 # DB helpers / migrations
 # -----------------------------------------------------------------------------
+_db_local = threading.local()
+
+def connect_db():
+    """
+    Open a tuned, autocommit SQLite connection.
+    """
+    db = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    db.executescript(SQLITE_PRAGMAS)
+    if RUN_MAINTENANCE:
+        # checkpoint_loop copies the WAL back every CHECKPOINT_INTERVAL seconds,
+        # so no commit here pays for it. Processes without it keep SQLite's
+        # auto-checkpoint as the fallback.
+        db.execute("PRAGMA wal_autocheckpoint=0;")
+    db.row_factory = sqlite3.Row
+    return db
+
 def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
-@app.teardown_appcontext
-def close_db(exc):
-    db = g.pop("db", None)
-    if db:
-        db.close()
+    """
+    One long-lived connection per worker thread, so the PRAGMAs
+    are paid once instead of on every request.
+    """
+    db = getattr(_db_local, "db", None)
+    if db is None:
+        db = _db_local.db = connect_db()
+    return db
+
+_schema_ready = False
 
 def ensure_columns(db):
     """
-    Create tables if missing and try to backfill new columns.
-    Safe to run every request.
+    Create tables and indexes if missing and backfill new columns.
+    Runs once at startup (see init_db); later calls return immediately.
     """
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pageviews (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            path TEXT NOT NULL,
-            referrer TEXT,
-            ua_browser TEXT,
-            ua_os TEXT,
-            ip_bucket TEXT,
-            country TEXT
-        );
-        """
-    )
+    global _schema_ready
+    if _schema_ready:
+        return
 
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            event_type TEXT NOT NULL,
-            page_path TEXT,
-            target TEXT,
-            ua_browser TEXT,
-            ua_os TEXT,
-            ip_bucket TEXT,
-            country TEXT
-        );
-        """
-    )
+    for create_sql in TABLES.values():
+        db.execute(create_sql)
 
-    # try to add missing columns on upgrade
+    # add missing columns on upgrade
     for table, coldefs in {
         "pageviews": [
-            "ts TEXT",
+            "ts INTEGER",
             "path TEXT",
             "referrer TEXT",
             "ua_browser TEXT",
@@ -118,7 +173,7 @@ def ensure_columns(db):
             "country TEXT"
         ],
         "events": [
-            "ts TEXT",
+            "ts INTEGER",
             "event_type TEXT",
             "page_path TEXT",
             "target TEXT",
@@ -128,101 +183,464 @@ def ensure_columns(db):
             "country TEXT"
         ],
     }.items():
+        existing = {row["name"] for row in db.execute(f"PRAGMA table_info({table});")}
         for coldef in coldefs:
-            colname = coldef.split()[0]
-            try:
-                db.execute(f"SELECT {colname} FROM {table} LIMIT 1;")
-            except sqlite3.OperationalError:
+            if coldef.split()[0] not in existing:
                 db.execute(f"ALTER TABLE {table} ADD COLUMN {coldef};")
 
-    db.commit()
+    for table in TABLES:
+        migrate_ts_to_epoch(db, table)
 
-@app.before_request
-def before():
-    db = get_db()
-    ensure_columns(db)
+    ensure_rollups(db)
 
-    # retention cleanup
+    # covering index for the referrer query, the only one still reading raw rows;
+    # it also serves retention. Raw events are only read by retention, which
+    # needs just ts. Everything else is in the rollups.
+    db.executescript(
+        """
+        CREATE INDEX IF NOT EXISTS ix_pv_ts_ref ON pageviews(ts, referrer);
+        CREATE INDEX IF NOT EXISTS ix_ev_ts ON events(ts);
+        PRAGMA analysis_limit=1000;
+        ANALYZE;
+        """
+    )
+    _schema_ready = True
+
+# Raw tables; ts is stored as INTEGER unix epoch seconds (UTC)
+TABLES = {
+    "pageviews": """
+        CREATE TABLE IF NOT EXISTS pageviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            referrer TEXT,
+            ua_browser TEXT,
+            ua_os TEXT,
+            ip_bucket TEXT,
+            country TEXT
+        );
+        """,
+    "events": """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            page_path TEXT,
+            target TEXT,
+            ua_browser TEXT,
+            ua_os TEXT,
+            ip_bucket TEXT,
+            country TEXT
+        );
+        """,
+}
+
+def migrate_ts_to_epoch(db, table):
+    """
+    Rebuild a table whose ts column is still declared TEXT (ISO-8601 strings)
+    so ts holds INTEGER epoch seconds. A TEXT column would turn integers back
+    into strings, so the table has to be recreated. The type is re-checked
+    under the write lock, so only the first worker does the copy.
+    Indexes go with the old table and are recreated by ensure_columns.
+    """
+    db.execute("BEGIN IMMEDIATE;")
+    try:
+        types = {row["name"]: row["type"] for row in db.execute(f"PRAGMA table_info({table});")}
+        if types["ts"].upper() == "TEXT":
+            columns = list(types)
+            db.execute(f"ALTER TABLE {table} RENAME TO {table}_old;")
+            db.execute(TABLES[table])
+            select = ", ".join(
+                "CAST(strftime('%s', ts) AS INTEGER)" if c == "ts" else c for c in columns
+            )
+            db.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {select} FROM {table}_old;"
+            )
+            db.execute(f"DROP TABLE {table}_old;")
+    except Exception:
+        db.execute("ROLLBACK;")
+        raise
+    db.execute("COMMIT;")
+
+# Per-day rollups the dashboard reads instead of raw rows:
+# table name -> (CREATE TABLE, backfill from raw rows)
+ROLLUPS = {
+    "pageviews_daily": (
+        """
+        CREATE TABLE pageviews_daily (
+            day TEXT NOT NULL,
+            path TEXT NOT NULL,
+            country TEXT NOT NULL,
+            ua_browser TEXT NOT NULL,
+            ua_os TEXT NOT NULL,
+            views INTEGER NOT NULL,
+            PRIMARY KEY (day, path, country, ua_browser, ua_os)
+        ) WITHOUT ROWID;
+        """,
+        """
+        INSERT INTO pageviews_daily (day, path, country, ua_browser, ua_os, views)
+        SELECT date(ts, 'unixepoch'), path, COALESCE(country, ''), COALESCE(ua_browser, ''),
+               COALESCE(ua_os, ''), COUNT(*)
+        FROM pageviews
+        GROUP BY 1, 2, 3, 4, 5;
+        """,
+    ),
+    # target is optional; stored as '' because it is part of the key
+    "events_daily": (
+        """
+        CREATE TABLE events_daily (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            target TEXT NOT NULL,
+            hits INTEGER NOT NULL,
+            PRIMARY KEY (day, event_type, target)
+        ) WITHOUT ROWID;
+        """,
+        """
+        INSERT INTO events_daily (day, event_type, target, hits)
+        SELECT date(ts, 'unixepoch'), event_type, COALESCE(target, ''), COUNT(*)
+        FROM events
+        GROUP BY 1, 2, 3;
+        """,
+    ),
+}
+
+def ensure_rollups(db):
+    """
+    Create the per-day rollup tables, backfilling each from raw rows
+    the first time. The lock keeps concurrent workers from double-counting.
+    """
+    db.execute("BEGIN IMMEDIATE;")
+    try:
+        for table, (create_sql, backfill_sql) in ROLLUPS.items():
+            exists = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                (table,),
+            ).fetchone()
+            if not exists:
+                db.execute(create_sql)
+                db.execute(backfill_sql)
+    except Exception:
+        db.execute("ROLLBACK;")
+        raise
+    db.execute("COMMIT;")
+
+def purge_expired(db):
+    """
+    Retention cleanup: drop rows older than RETENTION_DAYS.
+    """
     db.execute(
         """
         DELETE FROM pageviews
-        WHERE ts < datetime('now', ?)
+        WHERE ts < CAST(strftime('%s', 'now', ?) AS INTEGER)
         """,
         (f"-{RETENTION_DAYS} days",),
     )
     db.execute(
         """
         DELETE FROM events
-        WHERE ts < datetime('now', ?)
+        WHERE ts < CAST(strftime('%s', 'now', ?) AS INTEGER)
         """,
         (f"-{RETENTION_DAYS} days",),
     )
-    db.commit()
+    for table in ROLLUPS:
+        db.execute(
+            f"""
+            DELETE FROM {table}
+            WHERE day < date('now', ?)
+            """,
+            (f"-{RETENTION_DAYS} days",),
+        )
+
+def init_db():
+    """
+    Create/migrate the schema. Another process may be in the middle of the
+    one-time ts migration or rollup backfill, which can take far longer than
+    busy_timeout, so wait for it (up to INIT_BUSY_TIMEOUT_MS) instead of
+    failing the import.
+    """
+    db = connect_db()
+    db.execute(f"PRAGMA busy_timeout={INIT_BUSY_TIMEOUT_MS};")
+    try:
+        ensure_columns(db)
+    finally:
+        db.close()
+
+def maintenance_loop():
+    """
+    Retention cleanup and index statistics off the request path:
+    once at startup, then every RETENTION_INTERVAL seconds.
+    """
+    db = connect_db()
+    while True:
+        try:
+            purge_expired(db)
+            # refresh planner statistics for the indexes as the tables grow
+            db.execute("PRAGMA optimize;")
+        except sqlite3.Error:
+            app.logger.exception("retention cleanup failed")
+        time.sleep(RETENTION_INTERVAL)
+
+def checkpoint_loop():
+    """
+    Copy committed WAL frames back into the DB file off the write path.
+    PASSIVE never blocks readers or the writer; frames still in use are
+    picked up on the next round.
+    """
+    db = connect_db()
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)
+        try:
+            db.execute("PRAGMA wal_checkpoint(PASSIVE);")
+        except sqlite3.Error:
+            app.logger.exception("WAL checkpoint failed")
+
+init_db()
+
+if RUN_MAINTENANCE:
+    _maintenance = threading.Thread(target=maintenance_loop, name="analytics-maintenance", daemon=True)
+    _maintenance.start()
+    _checkpointer = threading.Thread(target=checkpoint_loop, name="analytics-checkpoint", daemon=True)
+    _checkpointer.start()
+
+
+# -----------------------------------------------------------------------------
+# Background writer
+# -----------------------------------------------------------------------------
+# Batches are written as multi-row INSERT ... VALUES (...), (...) statements:
+# one parse and one VDBE program per statement instead of one step per row.
+# Timestamps are taken by SQLite at flush time as integer epoch seconds,
+# not formatted per request in Python.
+PAGEVIEW_INSERT = (
+    "INSERT INTO pageviews (ts, path, referrer, ua_browser, ua_os, ip_bucket, country) VALUES ",
+    "(CAST(strftime('%s', 'now') AS INTEGER), ?, ?, ?, ?, ?, ?)",
+    "",
+)
+PAGEVIEW_DAILY_UPSERT = (
+    "INSERT INTO pageviews_daily (day, path, country, ua_browser, ua_os, views) VALUES ",
+    "(date('now'), ?, ?, ?, ?, ?)",
+    " ON CONFLICT (day, path, country, ua_browser, ua_os)"
+    " DO UPDATE SET views = views + excluded.views",
+)
+EVENT_DAILY_UPSERT = (
+    "INSERT INTO events_daily (day, event_type, target, hits) VALUES ",
+    "(date('now'), ?, ?, ?)",
+    " ON CONFLICT (day, event_type, target)"
+    " DO UPDATE SET hits = hits + excluded.hits",
+)
+EVENT_INSERT = (
+    "INSERT INTO events (ts, event_type, page_path, target, ua_browser, ua_os, ip_bucket, country) VALUES ",
+    "(CAST(strftime('%s', 'now') AS INTEGER), ?, ?, ?, ?, ?, ?, ?)",
+    "",
+)
+# SQLite's historical default for SQLITE_MAX_VARIABLE_NUMBER (newer builds allow more)
+SQLITE_MAX_VARIABLES = 999
+
+_write_q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_STOP = object()
+
+def enqueue_write(kind: str, row: tuple):
+    """
+    Hand a row to the writer thread. kind is "pv" (pageview) or "ev" (event).
+    Drops the row if the writer has fallen WRITE_QUEUE_SIZE rows behind.
+    """
+    try:
+        _write_q.put_nowait((kind, row))
+    except queue.Full:
+        app.logger.warning("analytics write queue full, dropping %s row", kind)
+
+def insert_rows(db, statement, rows):
+    """
+    Insert rows with as few multi-row statements as the bound-parameter
+    limit allows. statement is a (head, row placeholder, tail) triple.
+    """
+    head, placeholder, tail = statement
+    per_statement = SQLITE_MAX_VARIABLES // placeholder.count("?")
+    for i in range(0, len(rows), per_statement):
+        chunk = rows[i:i + per_statement]
+        db.execute(
+            head + ", ".join([placeholder] * len(chunk)) + tail,
+            [value for row in chunk for value in row],
+        )
+
+def flush_batch(db, batch):
+    """
+    Insert a batch of queued rows in a single transaction
+    and fold them into the daily rollups.
+    """
+    pageviews = [row for kind, row in batch if kind == "pv"]
+    events = [row for kind, row in batch if kind == "ev"]
+
+    # (path, referrer, ua_browser, ua_os, ip_bucket, country)
+    daily = Counter(
+        (path, country, ua_browser, ua_os)
+        for path, _, ua_browser, ua_os, _, country in pageviews
+    )
+    # (event_type, page_path, target, ua_browser, ua_os, ip_bucket, country)
+    events_daily = Counter((event_type, target or "") for event_type, _, target, *_ in events)
+
+    db.execute("BEGIN IMMEDIATE;")
+    try:
+        if pageviews:
+            insert_rows(db, PAGEVIEW_INSERT, pageviews)
+            insert_rows(db, PAGEVIEW_DAILY_UPSERT, [key + (n,) for key, n in daily.items()])
+        if events:
+            insert_rows(db, EVENT_INSERT, events)
+            insert_rows(db, EVENT_DAILY_UPSERT, [key + (n,) for key, n in events_daily.items()])
+        db.execute("COMMIT;")
+    except Exception:
+        if db.in_transaction:
+            db.execute("ROLLBACK;")
+        raise
+
+def is_busy(exc):
+    """
+    True for SQLITE_BUSY (and its extended codes): another connection held
+    the write lock for longer than busy_timeout.
+    """
+    return (
+        isinstance(exc, sqlite3.OperationalError)
+        and exc.sqlite_errorcode & 0xFF == sqlite3.SQLITE_BUSY
+    )
+
+def write_batch(db, batch):
+    """
+    Flush a batch, retrying for as long as the database stays locked
+    (e.g. another process's retention DELETE). Any other failure is retried
+    row by row, so one bad row only loses itself and not the whole batch.
+    """
+    while True:
+        try:
+            flush_batch(db, batch)
+            return
+        except Exception as exc:
+            if is_busy(exc):
+                app.logger.warning("database busy, retrying %d analytics rows", len(batch))
+                continue
+            if len(batch) == 1:
+                app.logger.exception("dropping analytics row %r", batch[0])
+                return
+            app.logger.exception("failed to write %d analytics rows, retrying one by one", len(batch))
+            break
+    for item in batch:
+        write_batch(db, [item])
+
+def writer_loop():
+    """
+    Block for the first queued row, then keep collecting for up to
+    WRITE_FLUSH_INTERVAL seconds (or WRITE_BATCH_ROWS rows) and flush.
+    """
+    db = connect_db()
+    stopping = False
+    while not stopping:
+        item = _write_q.get()
+        batch = []
+        deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+        while True:
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH_ROWS:
+                break
+            try:
+                item = _write_q.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+
+        if batch:
+            try:
+                write_batch(db, batch)
+            except Exception:
+                # never let one batch take the only writer thread down
+                app.logger.exception("failed to write %d analytics rows", len(batch))
+    db.close()
+
+def stop_writer():
+    # flush whatever is still queued before the worker exits
+    _write_q.put(_STOP)
+    _writer.join(timeout=10)
+
+_writer = threading.Thread(target=writer_loop, name="analytics-writer", daemon=True)
+_writer.start()
+atexit.register(stop_writer)
 
 
 # -----------------------------------------------------------------------------
 # Privacy helpers
 # -----------------------------------------------------------------------------
+# Dotted-quad IPv4 with the same rules as ipaddress (0-255, no leading zeros)
+_OCTET = r"(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+_IPV4_RE = re.compile(r"\.".join([_OCTET] * 4))
+
+@functools.lru_cache(maxsize=8192)
 def anonymize_ip(raw_ip: str) -> str:
     """
-    Bucket/truncate IP then HMAC with secret salt.
+    Bucket/truncate IP then hash it with keyed BLAKE2b (secret salt as key).
     Returns something like "v4:abcd1234..." or "v6:abcd1234...".
     """
-    try:
-        ip_obj = ipaddress.ip_address(raw_ip)
-    except ValueError:
-        return "invalid"
-
-    if isinstance(ip_obj, ipaddress.IPv4Address):
-        octets = raw_ip.split(".")
-        if len(octets) == 4:
-            truncated = f"{octets[0]}.{octets[1]}.0.0"
+    # truncate to bytes: IPv4 keeps the top /16, IPv6 the top /32
+    m = _IPV4_RE.fullmatch(raw_ip) if raw_ip else None
+    if m:
+        # common case, no ipaddress object needed
+        truncated = bytes((int(m[1]), int(m[2]), 0, 0))
+        version = "v4"
+    else:
+        try:
+            ip_obj = ipaddress.ip_address(raw_ip)
+        except ValueError:
+            return "invalid"
+        packed = ip_obj.packed
+        if ip_obj.version == 4:
+            truncated = packed[:2] + b"\x00\x00"
             version = "v4"
         else:
-            truncated = "0.0.0.0"
-            version = "v4"
-    else:
-        # IPv6: keep ~top /32 bits
-        as_int = int(ip_obj)
-        mask = (2**128 - 1) ^ (2**96 - 1)
-        truncated_int = as_int & mask
-        truncated_ip = ipaddress.IPv6Address(truncated_int)
-        truncated = truncated_ip.exploded
-        version = "v6"
-
-    digest = hmac.new(IP_SALT.encode("utf-8"), truncated.encode("utf-8"), hashlib.sha256).hexdigest()
-    return f"{version}:{digest[:16]}"
+            truncated = packed[:4] + b"\x00" * 12
+            version = "v6"
+
+    hasher = IP_HASHER.copy()
+    hasher.update(truncated)
+    digest = hasher.hexdigest()
+    return f"{version}:{digest}"
+
+# Every token parse_user_agent cares about, found in one pass. The lookahead
+# reports overlapping matches too, so this is equivalent to one `in` per token.
+_UA_TOKENS_RE = re.compile(
+    r"(?=(seamonkey|firefox|chromium|chrome|safari|edg|windows|mac os x|macintosh|android|iphone|ipad|ios|linux))",
+    re.IGNORECASE,
+)
 
+@functools.lru_cache(maxsize=8192)
 def parse_user_agent(ua: str):
     """
     Rough browser + OS classification (coarse on purpose).
     """
-    ua_lower = ua.lower()
+    tokens = {m.lower() for m in _UA_TOKENS_RE.findall(ua)}
 
     # browser
-    if "firefox" in ua_lower and "seamonkey" not in ua_lower:
+    if "firefox" in tokens and "seamonkey" not in tokens:
         browser = "Firefox"
-    elif "chrome" in ua_lower and "chromium" not in ua_lower and "edg" not in ua_lower:
+    elif "chrome" in tokens and "chromium" not in tokens and "edg" not in tokens:
         browser = "Chrome"
-    elif "safari" in ua_lower and "chrome" not in ua_lower:
+    elif "safari" in tokens and "chrome" not in tokens:
         browser = "Safari"
-    elif "edg" in ua_lower:
+    elif "edg" in tokens:
         browser = "Edge"
-    elif "chromium" in ua_lower:
+    elif "chromium" in tokens:
         browser = "Chromium"
     else:
         browser = "Other"
 
     # OS
-    if "windows" in ua_lower:
+    if "windows" in tokens:
         os_name = "Windows"
-    elif "mac os x" in ua_lower or "macintosh" in ua_lower:
+    elif "mac os x" in tokens or "macintosh" in tokens:
         os_name = "macOS"
-    elif "android" in ua_lower:
+    elif "android" in tokens:
         os_name = "Android"
-    elif "iphone" in ua_lower or "ipad" in ua_lower or "ios" in ua_lower:
+    elif "iphone" in tokens or "ipad" in tokens or "ios" in tokens:
         os_name = "iOS"
-    elif "linux" in ua_lower:
+    elif "linux" in tokens:
         os_name = "Linux"
     else:
         os_name = "Other"
@@ -249,21 +667,49 @@ def get_country_from_ip(raw_ip: str) -> str:
     reader = get_geoip_reader()
     if reader is None or not raw_ip:
         return "UNK"
+    return lookup_country(reader, raw_ip)
+
+@functools.lru_cache(maxsize=65536)
+def lookup_country(reader, raw_ip: str) -> str:
+    """
+    Cached per reader and IP, so repeat visitors skip the DB lookup and
+    nothing looked up before the DB was available stays "UNK".
+    """
     try:
-        resp = reader.country(raw_ip)
-        code = resp.country.iso_code or resp.registered_country.iso_code
-        return code if code else "UNK"
-    except (geoip2.errors.AddressNotFoundError, ValueError):
+        # raw record dict; no geoip2 model objects per lookup
+        record = reader.get(raw_ip)
+    except ValueError:
+        return "UNK"
+    if not record:
         return "UNK"
+    code = (record.get("country") or {}).get("iso_code") or \
+        (record.get("registered_country") or {}).get("iso_code")
+    return code if code else "UNK"
+
+def client_ip(xff: str | None, remote_addr: str | None) -> str | None:
+    """
+    Client address, as seen through the reverse proxy.
+    """
+    # behind a proxy X-Forwarded-For is "client, proxy1, proxy2"; keep the client
+    return xff.split(",", 1)[0].strip() if xff else remote_addr
 
 def request_fingerprint(req):
     """
     Extract anonymized metadata for pageviews and events.
     """
-    src_ip = req.headers.get("X-Forwarded-For", req.remote_addr)
+    src_ip = client_ip(req.headers.get("X-Forwarded-For"), req.remote_addr)
+    return fingerprint(src_ip, req.headers.get("User-Agent", ""))
+
+def fingerprint(src_ip, user_agent):
+    """
+    Anonymized metadata from the raw client IP and User-Agent.
+    Doesn't touch the request, so it can run after the response is sent.
+    Not cached as a whole: each helper has its own cache, and the country
+    must stay uncached until the GeoIP DB is available.
+    """
     ip_bucket = anonymize_ip(src_ip)
     country_code = get_country_from_ip(src_ip)
-    ua_browser, ua_os = parse_user_agent(req.headers.get("User-Agent", ""))
+    ua_browser, ua_os = parse_user_agent(user_agent)
 
     return {
         "ip_bucket": ip_bucket,
@@ -276,12 +722,7 @@ def pick_cors_origin(request_origin: str | None) -> str | None:
     """
     Return allowed origin if it matches our allowlist.
     """
-    if not request_origin:
-        return None
-    for allowed in CORS_ALLOW_ORIGINS:
-        if request_origin == allowed:
-            return allowed
-    return None
+    return request_origin if request_origin in CORS_ALLOW_ORIGINS else None
 
 @app.after_request
 def add_cors_headers(resp):
@@ -289,6 +730,9 @@ def add_cors_headers(resp):
     Attach CORS headers if this was a cross-origin call from an allowed Origin.
     For same-origin (/analytics/... reverse proxy) CORS won't be needed.
     """
+    if request.endpoint in NO_CORS_ENDPOINTS:
+        return resp
+
     origin = pick_cors_origin(request.headers.get("Origin"))
 
     if origin:
@@ -307,29 +751,18 @@ def add_cors_headers(resp):
 # -----------------------------------------------------------------------------
 # Ingest routes
 # -----------------------------------------------------------------------------
-@app.route("/148a2801968b695634b116e620005dbb.gif")
-def pixel():
+def record_pageview(src_ip, user_agent, path, raw_ref):
     """
-    Tracking pixel endpoint.
-    IMPORTANT: this route name stays EXACTLY as provided.
-    You include it like:
-      <img src="/analytics/148a2801968b695634b116e620005dbb.gif?p=/path">
+    Fingerprint one pixel hit and queue it for the writer.
+    Shared by pixel() and the nginx log sidecar (ingest.py).
     """
-    meta = request_fingerprint(request)
-
-    # capture the path being viewed (from the query param you add in HTML/JS)
-    path = request.args.get("p", "/")
+    meta = fingerprint(src_ip, user_agent)
     # capture referring site (domain only)
-    ref = sanitize_referrer(request.headers.get("Referer"))
+    ref = sanitize_referrer(raw_ref)
 
-    db = get_db()
-    db.execute(
-        """
-        INSERT INTO pageviews (ts, path, referrer, ua_browser, ua_os, ip_bucket, country)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
+    enqueue_write(
+        "pv",
         (
-            datetime.now(timezone.utc).isoformat(timespec="seconds"),
             path[:500],
             (ref[:255] if ref else None),
             meta["ua_browser"][:50],
@@ -338,15 +771,43 @@ def pixel():
             meta["country"][:4],
         ),
     )
-    db.commit()
 
-    resp = Response(PIXEL_BYTES, mimetype="image/gif")
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
-    resp.headers["Expires"] = "0"
+@app.route("/148a2801968b695634b116e620005dbb.gif")
+def pixel():
+    """
+    Tracking pixel endpoint.
+    In the compose setup nginx answers this URL itself (see nginx.conf);
+    this route stays as the fallback when the app is hit directly.
+    IMPORTANT: this route name stays EXACTLY as provided.
+    You include it like:
+      <img src="/analytics/148a2801968b695634b116e620005dbb.gif?p=/path">
+    """
+    # grab the raw inputs now; the request is gone once the response closes
+    record = functools.partial(
+        record_pageview,
+        client_ip(request.headers.get("X-Forwarded-For"), request.remote_addr),
+        request.headers.get("User-Agent", ""),
+        # capture the path being viewed (from the query param you add in HTML/JS)
+        request.args.get("p", "/"),
+        request.headers.get("Referer"),
+    )
+
+    # copy: Response keeps a Headers instance as-is and after_request mutates it
+    resp = Response(PIXEL_BYTES, headers=PIXEL_HEADERS.copy())
+    # fingerprint + enqueue only after the bytes have gone out
+    # (no direct_passthrough: Werkzeug skips close callbacks with it)
+    resp.call_on_close(record)
     return resp
 
 
+def clean_text(value, limit):
+    """
+    str() a JSON value, truncated to limit and made encodable as UTF-8:
+    JSON may carry lone surrogates ("\\ud800") that SQLite cannot store.
+    """
+    return str(value)[:limit].encode("utf-8", "replace").decode("utf-8")
+
+
 @app.route("/event", methods=["POST", "OPTIONS"])
 def event():
     """
@@ -361,22 +822,17 @@ def event():
         return ("", 200)
 
     data = request.get_json(silent=True) or {}
-    event_type = str(data.get("type", "unknown"))[:50]
-    page_path = str(data.get("page", "/"))[:500]
+    event_type = clean_text(data.get("type", "unknown"), 50)
+    page_path = clean_text(data.get("page", "/"), 500)
     target = data.get("target")
     if target is not None:
-        target = str(target)[:500]
+        target = clean_text(target, 500)
 
     meta = request_fingerprint(request)
 
-    db = get_db()
-    db.execute(
-        """
-        INSERT INTO events (ts, event_type, page_path, target, ua_browser, ua_os, ip_bucket, country)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
+    enqueue_write(
+        "ev",
         (
-            datetime.now(timezone.utc).isoformat(timespec="seconds"),
             event_type,
             page_path,
             target,
@@ -386,7 +842,6 @@ def event():
             meta["country"][:4],
         ),
     )
-    db.commit()
 
     return jsonify({"ok": True})
 
@@ -411,21 +866,13 @@ def build_sparkline(points, width=320, height=60, stroke="#38bdf8"):
     span_c = max_c - min_c or 1
 
     n = len(points)
-    if n == 1:
-        xs = [width / 2]
-    else:
-        xs = [i * (width / (n - 1)) for i in range(n)]
-
-    ys = [
-        height - ((c - min_c) / span_c) * (height - 4) - 2
-        for c in counts
-    ]
+    x0 = width / 2 if n == 1 else 0
+    step = width / (n - 1) if n > 1 else 0
 
-    d_parts = []
-    for i, (x, y) in enumerate(zip(xs, ys)):
-        cmd = "M" if i == 0 else "L"
-        d_parts.append(f"{cmd}{x:.1f},{y:.1f}")
-    d_attr = " ".join(d_parts)
+    d_attr = " ".join(
+        "%s%.1f,%.1f" % ("L" if i else "M", x0 + i * step, height - ((c - min_c) / span_c) * (height - 4) - 2)
+        for i, c in enumerate(counts)
+    )
 
     svg = f'''
 <svg width="{width}" height="{height}" viewBox="0 0 {width} {height}"
@@ -440,98 +887,8 @@ def build_sparkline(points, width=320, height=60, stroke="#38bdf8"):
 # -----------------------------------------------------------------------------
 # Dashboard
 # -----------------------------------------------------------------------------
-@app.route("/stats")
-def stats():
-    token = request.args.get("token", "")
-    if token != DASH_TOKEN:
-        return abort(403)
-
-    db = get_db()
-
-    # Top pages (30d)
-    recent_paths = db.execute(
-        """
-        SELECT path, COUNT(*) as views
-        FROM pageviews
-        WHERE ts >= datetime('now', '-30 days')
-        GROUP BY path
-        ORDER BY views DESC
-        LIMIT 50;
-        """
-    ).fetchall()
-
-    total_views_30d = sum(row["views"] for row in recent_paths)
-
-    # Top referrers (30d)
-    recent_referrers = db.execute(
-        """
-        SELECT referrer, COUNT(*) as hits
-        FROM pageviews
-        WHERE ts >= datetime('now', '-30 days') AND referrer IS NOT NULL
-        GROUP BY referrer
-        ORDER BY hits DESC
-        LIMIT 50;
-        """
-    ).fetchall()
-
-    # Countries (30d)
-    recent_countries = db.execute(
-        """
-        SELECT country, COUNT(*) as hits
-        FROM pageviews
-        WHERE ts >= datetime('now', '-30 days')
-        GROUP BY country
-        ORDER BY hits DESC;
-        """
-    ).fetchall()
-
-    # Browser / OS (30d)
-    recent_agents = db.execute(
-        """
-        SELECT ua_browser, ua_os, COUNT(*) as hits
-        FROM pageviews
-        WHERE ts >= datetime('now', '-30 days')
-        GROUP BY ua_browser, ua_os
-        ORDER BY hits DESC;
-        """
-    ).fetchall()
-
-    # Events (30d)
-    recent_events = db.execute(
-        """
-        SELECT event_type, target, COUNT(*) as hits
-        FROM events
-        WHERE ts >= datetime('now', '-30 days')
-        GROUP BY event_type, target
-        ORDER BY hits DESC
-        LIMIT 50;
-        """
-    ).fetchall()
-
-    total_events_30d = sum(row["hits"] for row in recent_events)
-
-    # pick top page / country
-    top_page = recent_paths[0]["path"] if recent_paths else "-"
-    top_country = recent_countries[0]["country"] if recent_countries else "-"
-
-    # views per day for sparkline
-    by_day = db.execute(
-        """
-        SELECT strftime('%Y-%m-%d', ts) AS day, COUNT(*) AS views
-        FROM pageviews
-        WHERE ts >= datetime('now', '-30 days')
-        GROUP BY day
-        ORDER BY day ASC;
-        """
-    ).fetchall()
-
-    day_points = [(row["day"], row["views"]) for row in by_day]
-    spark = build_sparkline(day_points, width=320, height=60, stroke="#38bdf8")
-    spark_svg = spark["svg"]
-    spark_last = spark["last_count"]
-
-    # dashboard HTML with Referrers card added
-    html = """
+# dashboard HTML with Referrers card added; compiled once at import
+STATS_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -929,9 +1286,112 @@ td.num{
 </body>
 </html>
 """
+STATS_TEMPLATE = app.jinja_env.from_string(STATS_HTML)
+
+
+@app.route("/stats")
+def stats():
+    token = request.args.get("token", "")
+    if token != DASH_TOKEN:
+        return abort(403)
+
+    db = get_db()
+
+    # Top pages (30d)
+    recent_paths = db.execute(
+        """
+        SELECT path, SUM(views) as views
+        FROM pageviews_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY path
+        ORDER BY views DESC
+        LIMIT 50;
+        """
+    ).fetchall()
+
+    total_views_30d = db.execute(
+        """
+        SELECT COALESCE(SUM(views), 0)
+        FROM pageviews_daily
+        WHERE day >= date('now', '-30 days');
+        """
+    ).fetchone()[0]
+
+    # Top referrers (30d, the same calendar days the rollup-backed cards cover)
+    recent_referrers = db.execute(
+        """
+        SELECT referrer, COUNT(*) as hits
+        FROM pageviews
+        WHERE ts >= CAST(strftime('%s', date('now', '-30 days')) AS INTEGER) AND referrer IS NOT NULL
+        GROUP BY referrer
+        ORDER BY hits DESC
+        LIMIT 50;
+        """
+    ).fetchall()
+
+    # Countries (30d)
+    recent_countries = db.execute(
+        """
+        SELECT country, SUM(views) as hits
+        FROM pageviews_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY country
+        ORDER BY hits DESC;
+        """
+    ).fetchall()
+
+    # Browser / OS (30d)
+    recent_agents = db.execute(
+        """
+        SELECT ua_browser, ua_os, SUM(views) as hits
+        FROM pageviews_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY ua_browser, ua_os
+        ORDER BY hits DESC;
+        """
+    ).fetchall()
+
+    # Events (30d)
+    recent_events = db.execute(
+        """
+        SELECT event_type, NULLIF(target, '') as target, SUM(hits) as hits
+        FROM events_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY event_type, target
+        ORDER BY hits DESC
+        LIMIT 50;
+        """
+    ).fetchall()
+
+    total_events_30d = db.execute(
+        """
+        SELECT COALESCE(SUM(hits), 0)
+        FROM events_daily
+        WHERE day >= date('now', '-30 days');
+        """
+    ).fetchone()[0]
+
+    # pick top page / country
+    top_page = recent_paths[0]["path"] if recent_paths else "-"
+    top_country = recent_countries[0]["country"] if recent_countries else "-"
+
+    # views per day for sparkline
+    by_day = db.execute(
+        """
+        SELECT day, SUM(views) AS views
+        FROM pageviews_daily
+        WHERE day >= date('now', '-30 days')
+        GROUP BY day
+        ORDER BY day ASC;
+        """
+    ).fetchall()
+
+    # rows are (day, views) already; build_sparkline only indexes them
+    spark = build_sparkline(by_day, width=320, height=60, stroke="#38bdf8")
+    spark_svg = spark["svg"]
+    spark_last = spark["last_count"]
 
-    return render_template_string(
-        html,
+    return STATS_TEMPLATE.render(
         retention=RETENTION_DAYS,
         total_views_30d=total_views_30d,
         total_events_30d=total_events_30d,
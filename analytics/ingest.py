@@ -0,0 +1,66 @@
+"""
+Pixel log sidecar.
+
+nginx serves the tracking pixel itself (see nginx.conf) and sends one
+syslog datagram per hit, carrying a JSON access-log line. This turns those
+into pageview rows through the same fingerprinting and batch writer as
+the Flask app.
+
+Listens on the unix datagram socket INGEST_SOCKET when it is set,
+otherwise on UDP INGEST_HOST:INGEST_PORT.
+"""
+import json
+import os
+import signal
+import socket
+import sys
+from urllib.parse import unquote_plus
+
+import app as analytics
+
+INGEST_HOST = os.environ.get("INGEST_HOST", "0.0.0.0")
+INGEST_PORT = int(os.environ.get("INGEST_PORT", "5140"))
+INGEST_SOCKET = os.environ.get("INGEST_SOCKET")
+
+
+def handle(datagram: bytes):
+    """
+    Parse one syslog datagram: "<190>Oct 15 12:00:00 pixel: {...json...}".
+    """
+    line = datagram.decode("utf-8", "replace")
+    hit = json.loads(line[line.index("{"):])
+
+    analytics.record_pageview(
+        analytics.client_ip(hit.get("xff") or None, hit.get("ip") or None),
+        hit.get("ua", ""),
+        # $arg_p is logged still URL-encoded
+        unquote_plus(hit.get("p") or "/"),
+        hit.get("ref") or None,
+    )
+
+
+def main():
+    # docker stop sends SIGTERM; exit normally so the writer flushes its queue
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if INGEST_SOCKET:
+        # a previous container may have left its socket file behind
+        if os.path.exists(INGEST_SOCKET):
+            os.unlink(INGEST_SOCKET)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(INGEST_SOCKET)
+        # nginx workers run as an unprivileged user
+        os.chmod(INGEST_SOCKET, 0o666)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((INGEST_HOST, INGEST_PORT))
+    while True:
+        datagram, _ = sock.recvfrom(65535)
+        try:
+            handle(datagram)
+        except ValueError:
+            analytics.app.logger.warning("skipping malformed pixel log line: %r", datagram[:200])
+
+
+if __name__ == "__main__":
+    main()
@@ -18,9 +18,16 @@ Usage examples:
   
   # Resize and compress for web
   python watermark.py ./photos -o ./web --resize 1920 --quality 80
+
+Speed:
+  Pillow-SIMD is a drop-in replacement for Pillow with SSE4/AVX2 resampling
+  and color conversion; build it against libjpeg-turbo for faster JPEG I/O:
+    pip uninstall -y pillow && CC="cc -mavx2" pip install -U --force-reinstall pillow-simd
 """
 
 import argparse
+import concurrent.futures
+import functools
 import os
 from pathlib import Path
 from typing import Tuple
@@ -28,9 +35,16 @@ from typing import Tuple
 from PIL import Image, ImageDraw, ImageFont
 
 # --------- Helpers ---------
+# Scratch canvas for text measurements (textbbox doesn't depend on its size)
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+# Font size used to measure the watermark before scaling it to fit
+MEASURE_REF_PX = 100
+
+@functools.lru_cache(maxsize=64)
 def load_font(font_path: str | None, px: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
     """
     Try user font, then common system fonts, then Pillow's bundled DejaVuSans.
+    Cached per (font_path, px): a folder run parses each TTF/size only once.
     """
     candidates = []
     if font_path:
@@ -102,47 +116,31 @@ def add_watermark(
     position: bottom-right|bottom-left|top-right|top-left|center
     stroke_ratio: outline thickness relative to font size
     """
-    if im.mode != "RGBA":
-        im = im.convert("RGBA")
+    # work on our own copy; the text tile is composited in place below.
+    # Opaque RGB sources stay RGB: no need for a full-size alpha band
+    opaque = im.mode == "RGB"
+    if opaque:
+        im = im.copy()
+    else:
+        im = im.convert("RGBA") if im.mode != "RGBA" else im.copy()
     W, H = im.size
 
     # --- Dynamic font sizing: make text ~ (scale * image width) ---
     # Interpret `scale` as desired text-width ratio of image width.
     target_text_w = max(1, int(W * scale))
 
-    # Start with a reasonable guess, then refine
-    test_px = max(12, int(W * scale))  # initial guess
-    font = load_font(font_path, test_px)
-
-    # Function to measure text width accurately with anchor-insensitive metric
-    def measure_text_w(fnt: ImageFont.ImageFont) -> int:
-        # textbbox gives (l, t, r, b)
-        tmp_img = Image.new("RGB", (10, 10))
-        tmp_draw = ImageDraw.Draw(tmp_img)
-        l, t, r, b = tmp_draw.textbbox((0, 0), text, font=fnt, stroke_width=max(1, int(fnt.size * 0.12)))
-        return r - l
-
-    # Adjust font size using a couple of passes
-    for _ in range(8):
-        w_now = measure_text_w(font)
-        if w_now == 0:
-            break
-        ratio = target_text_w / w_now
-        if 0.95 <= ratio <= 1.05:
-            break
-        # Update size (limit growth to avoid overshoot)
-        new_px = int(font.size * min(1.5, max(0.67, ratio)))
-        new_px = max(12, min(new_px, max(W, H)))  # clamp
-        if new_px == font.size:
-            break
-        font = load_font(font_path, new_px)
-
-    font_px = getattr(font, "size", test_px)
-    margin_px = max(2, int(min(W, H) * margin))
+    # Text width grows ~linearly with font size, so one measurement at a
+    # reference size is enough to pick the final size
+    ref_font = load_font(font_path, MEASURE_REF_PX)
+    l, t, r, b = _MEASURE_DRAW.textbbox(
+        (0, 0), text, font=ref_font, stroke_width=max(1, int(MEASURE_REF_PX * stroke_ratio))
+    )
+    ref_w = r - l
+    font_px = round(MEASURE_REF_PX * target_text_w / ref_w) if ref_w else target_text_w
+    font_px = max(12, min(font_px, max(W, H)))  # clamp
+    font = load_font(font_path, font_px)
 
-    # Create overlay
-    overlay = Image.new("RGBA", (W, H), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
+    margin_px = max(2, int(min(W, H) * margin))
 
     # Measure text (for centering accuracy with default font variations)
     # Using anchor simplifies placement; still keep stroke to improve legibility.
@@ -159,8 +157,26 @@ def add_watermark(
 
     # Soft drop shadow first (offset a couple of pixels)
     shadow_offset = max(1, int(font_px * 0.06))
+    shadow_xy = (xy[0] + shadow_offset, xy[1] + shadow_offset)
+
+    # Only the area under the text changes, so draw into a small tile covering
+    # text + shadow + stroke instead of a full-size overlay
+    l1, t1, r1, b1 = _MEASURE_DRAW.textbbox(xy, text, font=font, anchor=anchor, stroke_width=stroke_w)
+    l2, t2, r2, b2 = _MEASURE_DRAW.textbbox(shadow_xy, text, font=font, anchor=anchor)
+    pad = 2
+    bx, by = max(0, min(l1, l2) - pad), max(0, min(t1, t2) - pad)
+    bx2, by2 = min(W, max(r1, r2) + pad), min(H, max(b1, b2) + pad)
+    if bx2 <= bx or by2 <= by:
+        # text lies entirely outside the image
+        return im.convert("RGB")
+
+    tile = Image.new("RGBA", (bx2 - bx, by2 - by), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tile)
+    xy = (xy[0] - bx, xy[1] - by)
+    shadow_xy = (shadow_xy[0] - bx, shadow_xy[1] - by)
+
     draw.text(
-        (xy[0] + shadow_offset, xy[1] + shadow_offset),
+        shadow_xy,
         text,
         font=font,
         fill=shadow,
@@ -179,9 +195,12 @@ def add_watermark(
         stroke_fill=(0, 0, 0, int(a * 0.6)),
     )
 
-    # Composite
-    out = Image.alpha_composite(im, overlay)
-    return out.convert("RGB")  # default to RGB for broad compatibility
+    # Composite just the tile
+    if opaque:
+        im.paste(tile, (bx, by), tile)
+        return im
+    im.alpha_composite(tile, dest=(bx, by))
+    return im.convert("RGB")  # default to RGB for broad compatibility
 
 
 def process_one(
@@ -191,6 +210,11 @@ def process_one(
 ) -> None:
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with Image.open(in_path) as im:
+        if args.resize and args.resize > 0 and im.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale (never below the
+            # requested size) instead of decoding pixels thumbnail() drops
+            im.draft("RGB", (args.resize, args.resize))
+
         exif = im.info.get("exif")
         icc = im.info.get("icc_profile")
 
@@ -244,6 +268,12 @@ def process_one(
             out_img.save(out_path, **save_kwargs)
 
 
+def process_job(job: Tuple[Path, Path, argparse.Namespace]) -> Tuple[Path, Path]:
+    # Module-level so ProcessPoolExecutor can pickle it
+    src, dst, args = job
+    process_one(src, dst, args)
+    return src, dst
+
 
 def iter_images(root: Path):
     exts = {".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff"}
@@ -277,6 +307,8 @@ def main():
                         help="Resize output image so its longest side is N pixels (e.g., 1920)")
     parser.add_argument("--quality", type=int, default=85,
                         help="JPEG save quality (1-100, default: 85)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Parallel worker processes in folder mode (default: CPU count)")
 
     args = parser.parse_args()
 
@@ -304,14 +336,19 @@ def main():
 
     # Folder mode
     out_path.mkdir(parents=True, exist_ok=True)
+    jobs = []
     for src in iter_images(in_path):
         rel = src.relative_to(in_path)
         dst = out_path / rel
         if args.skip_existing and dst.exists():
             print(f"SKIP: {dst} already exists")
             continue
-        process_one(src, dst, args)
-        print(f"OK  : {src} -> {dst}")
+        jobs.append((src, dst, args))
+
+    # Images are independent and CPU-bound: spread them over processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as ex:
+        for src, dst in ex.map(process_job, jobs):
+            print(f"OK  : {src} -> {dst}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file